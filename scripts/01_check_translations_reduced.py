@@ -1,14 +1,16 @@
 """
-Check survey translations for consistency (same number of fields as English
-version).
+Check survey translations for consistency (same number of fields and same
+markup as English version).
 
 REDUCED VERSION
 
 """
 
+import collections
 import json_tricks
 import pandas as pd
 import pathlib
+import re
 
 
 LANGUAGES = ('en', 'de', 'nl', 'it', 'ru', 'ja', 'es')
@@ -18,6 +20,15 @@ countries_path = (pathlib.Path(__file__).parent.parent / 'data' /
 with open(countries_path, encoding='utf8') as f:
     countries = json_tricks.load(f)
 
+# Markup that must survive translation: slider title / description
+# separators, bold markers, references to other questions, HTML tags (without
+# attributes, which may be translated), and link targets.
+MARKUP_TOKEN_PATTERN = re.compile(r'#{6}'
+                                  r'|\*\*|__'
+                                  r'|\{[^{}\s]+\}'
+                                  r'|</?[a-zA-Z][a-zA-Z0-9]*'
+                                  r'|\]\([^()\s]*\)')
+
 
 def read_data(infile):
     excel_data = pd.read_excel(infile)
@@ -45,6 +56,56 @@ def read_data(infile):
     return excel_data
 
 
+def extract_markup_tokens(data, field):
+    # Tokens of all `<field>_<lang>` columns at once, as one sorted,
+    # joined string per question and language (empty if untranslated).
+    cols = [f'{field}_{lang}' for lang in LANGUAGES]
+    texts = data[cols].astype('string')
+    texts.columns = list(LANGUAGES)
+    texts = texts.stack().dropna()
+
+    tokens = (texts
+              .str.findall(MARKUP_TOKEN_PATTERN)
+              .map(lambda t: '\x1f'.join(sorted(t))))
+    tokens = tokens.unstack()
+    tokens = tokens.reindex(index=data.index, columns=list(LANGUAGES))
+    return tokens
+
+
+def check_markup(data):
+    mismatches = []
+    for field in ('title', 'choices'):
+        tokens = extract_markup_tokens(data, field)
+        translated = tokens.drop(columns='en')
+        differs = (translated.ne(tokens['en'], axis=0) &
+                   translated.notnull() &
+                   tokens[['en']].notnull().to_numpy())
+
+        for row_idx, lang in differs.stack().loc[lambda x: x].index:
+            expected = collections.Counter(
+                t for t in tokens.loc[row_idx, 'en'].split('\x1f') if t)
+            found = collections.Counter(
+                t for t in tokens.loc[row_idx, lang].split('\x1f') if t)
+            missing = sorted((expected - found).elements())
+            extra = sorted((found - expected).elements())
+            mismatches.append(dict(id=data.loc[row_idx, 'id'], field=field,
+                                   language=lang, missing=missing,
+                                   extra=extra))
+
+            msg = (f'Mismatch in markup of {field} for en vs {lang}: '
+                   f'{data.loc[row_idx, "id"]}\n')
+            if missing:
+                msg += f'\tmissing: {" ".join(missing)}\n'
+            if extra:
+                msg += f'\textra: {" ".join(extra)}\n'
+            print(msg)
+
+    mismatches = pd.DataFrame(mismatches,
+                              columns=['id', 'field', 'language', 'missing',
+                                       'extra'])
+    return mismatches
+
+
 def filter_data_by_session(data, session):
     data = data.copy()
     if session == 1:
@@ -67,16 +128,20 @@ def filter_data_by_session(data, session):
     return data
 
 
-def extract_question_data(q_data):
-    q_type = q_data['type'].iloc[0]
-    q_required = bool(q_data['required'].iloc[0])
+def get_column_positions(data):
+    return {col: pos for pos, col in enumerate(data.columns)}
+
+
+def extract_question_data(q_record, col_pos):
+    q_type = q_record[col_pos['type']]
+    q_required = bool(q_record[col_pos['required']])
 
-    if q_data['onlyVisibleIf'].isnull().iloc[0]:
+    if pd.isnull(q_record[col_pos['onlyVisibleIf']]):
         q_visible_if = None
     else:
-        q_visible_if = f"{q_data['onlyVisibleIf'].iloc[0]}"
+        q_visible_if = f"{q_record[col_pos['onlyVisibleIf']]}"
 
-    q_title = {lang: q_data[f'title_{lang}'].iloc[0]
+    q_title = {lang: q_record[col_pos[f'title_{lang}']]
                for lang in LANGUAGES}
 
     # Extract semi-colon-separated choices, and strip leading and
@@ -88,7 +153,7 @@ def extract_question_data(q_data):
         choices = {}
         print(q_title)
         for lang in LANGUAGES:
-            choices[lang] = q_data[f'choices_{lang}'].iloc[0]
+            choices[lang] = q_record[col_pos[f'choices_{lang}']]
             choices[lang] = choices[lang].split(';')
             choices[lang] = [c.strip() for c in choices[lang]]
 
@@ -96,7 +161,7 @@ def extract_question_data(q_data):
         for lang in LANGUAGES[1:]:
             if num_choices_en != len(choices[lang]):
                 msg = (f'Mismatch in number of choices for en vs {lang}: '
-                       f'{q_data["id"].iloc[0]}\n\n'
+                       f'{q_record[col_pos["id"]]}\n\n'
                        f'\ten:\n')
 
                 for choice in choices["en"]:
@@ -113,9 +178,10 @@ def extract_question_data(q_data):
     return q_type, q_title, q_choices, q_required, q_visible_if
 
 
-def gen_question(*, q_id, q_data, previous_home_test_item, language,
-                 other_text, none_text):
-    q_type, q_title, q_choices, q_required, q_visible_if = extract_question_data(q_data)
+def gen_question(*, q_id, q_record, col_pos, previous_home_test_item,
+                 language, other_text, none_text):
+    extracted = extract_question_data(q_record=q_record, col_pos=col_pos)
+    q_type, q_title, q_choices, q_required, q_visible_if = extracted
 
     if q_type not in ('radio', 'radio_with_other_option', 'checkbox',
                       'checkbox_with_other_option',
@@ -138,12 +204,24 @@ def gen_pages(data, previous_home_test_item, language):
                          .iloc[0])
                   for lang in LANGUAGES}
 
-    for _, page_data in data.groupby('page', sort=False):
-        for question_id, question_data in page_data.groupby('id', sort=False):
-            gen_question(
-                q_id=question_id, q_data=question_data,
-                previous_home_test_item=previous_home_test_item,
-                language=language, other_text=OTHER_TEXT, none_text=NONE_TEXT)
+    # Walk over the rows only once, as plain tuples. Only the first row of
+    # each ID on a page is checked, just like grouping by page and ID would.
+    col_pos = get_column_positions(data)
+    page_pos, id_pos = col_pos['page'], col_pos['id']
+    seen = set()
+
+    for q_record in data.itertuples(index=False, name=None):
+        page_id = q_record[page_pos]
+        question_id = q_record[id_pos]
+
+        if (page_id, question_id) in seen:
+            continue
+        seen.add((page_id, question_id))
+
+        gen_question(
+            q_id=question_id, q_record=q_record, col_pos=col_pos,
+            previous_home_test_item=previous_home_test_item,
+            language=language, other_text=OTHER_TEXT, none_text=NONE_TEXT)
 
 
 def gen_survey_json(infile, session, language):
@@ -167,6 +245,8 @@ def gen_html_elements(infile, language):
 
 
 if __name__ == '__main__':
+    check_markup(read_data(infile))
+
     sessions = [1, 2]
 
     for language, session in zip(LANGUAGES, sessions):
@@ -6,23 +6,51 @@ FULL VERSION
 
 """
 
+import concurrent.futures
+import contextlib
+import hashlib
 import markdown
 import json_tricks
 import pandas as pd
 import numpy as np
 import pathlib
+import sqlite3
+from PIL import Image, UnidentifiedImageError
 
 
 LANGUAGES = ('en', 'de', 'nl', 'it', 'ru', 'ja', 'es')
 infile = pathlib.Path(__file__).parent.parent / 'data' / 'Question Layout.xlsx'
+question_store = infile.with_suffix('.sqlite')
+assets_dir = pathlib.Path(__file__).parent.parent / 'assets'
+asset_manifest_path = assets_dir / 'manifest.json'
 countries_path = (pathlib.Path(__file__).parent.parent / 'data' /
                   'countries.json')
 with open(countries_path, encoding='utf8') as f:
     countries = json_tricks.load(f)
 
+# The cleaned question table can also be stored in, and read from, an
+# indexed SQLite file (see `write_question_store`).
+QUESTION_STORE_SUFFIXES = ('.sqlite', '.db')
+QUESTION_STORE_INDEXES = ('id', 'session', 'page', 'type')
 
-def read_data(infile):
+# Display width of image questions (the SurveyJS default); the height is
+# scaled to the aspect ratio of the image.
+IMAGE_DISPLAY_WIDTH = 200
+
+# Values of the `session` column included in each session.
+SESSION_SETS = {1: ('1', 'all'),
+                '>1': ('>1', 'all'),
+                'last': ('>1', 'all', 'last')}
+
+
+def read_data(infile, languages=LANGUAGES):
     excel_data = pd.read_excel(infile)
+    if languages is None:
+        # All languages with a `title_<lang>` column, English first.
+        languages = [col[len('title_'):] for col in excel_data.columns
+                     if col.startswith('title_')]
+        languages = ['en'] + [lang for lang in languages if lang != 'en']
+
     excel_data = excel_data.loc[(~excel_data['page'].isnull()) &
                                 (~excel_data['type'].isnull()), :]
 
@@ -40,45 +68,190 @@ def read_data(infile):
 
     cols = ['session', 'page', 'id', 'type', 'required', 'endSurveyIfResponse',
             'onlyVisibleIf']
-    cols.extend([f'title_{lang}' for lang in LANGUAGES])
-    cols.extend([f'choices_{lang}' for lang in LANGUAGES])
+    cols.extend([f'title_{lang}' for lang in languages])
+    cols.extend([f'choices_{lang}' for lang in languages])
     excel_data = excel_data[cols]
 
     return excel_data
 
 
-def filter_data_by_session(data, session):
-    data = data.copy()
+def is_question_store(infile):
+    return pathlib.Path(infile).suffix in QUESTION_STORE_SUFFIXES
+
+
+def write_question_store(data, outfile):
+    # Keep the original row labels, so the row order can be restored.
+    with contextlib.closing(sqlite3.connect(outfile)) as con, con:
+        data.to_sql('questions', con, if_exists='replace', index=True,
+                    index_label='row')
+        for col in QUESTION_STORE_INDEXES:
+            con.execute(f'CREATE INDEX questions_{col} '
+                        f'ON questions ("{col}")')
+
+
+def query_question_store(con, where=None, params=()):
+    query = 'SELECT * FROM questions'
+    if where is not None:
+        query += f' WHERE {where}'
+    query += ' ORDER BY "row"'
+
+    data = pd.read_sql_query(query, con, params=params, index_col='row')
+    data.index.name = None
+
+    # Restore the data types produced by `read_data`.
+    data['session'] = data['session'].astype(str)
+    data['page'] = data['page'].astype('int')
+    data['choices_en'] = data['choices_en'].astype(str)
+    data['title_en'] = data['title_en'].astype('string')
+    data['type'] = data['type'].astype('string')
+    data['onlyVisibleIf'] = data['onlyVisibleIf'].astype('string')
+
+    return data
+
+
+def read_question_store(infile, where=None, params=()):
+    with contextlib.closing(sqlite3.connect(infile)) as con:
+        data = query_question_store(con, where=where, params=params)
+
+    return data
+
+
+def lookup_question_store(con, data, where, params=()):
+    # Row positions in `data` (as returned by `query_question_store`) of the
+    # rows matching `where`, found via the indexes of the question store.
+    query = f'SELECT "row" FROM questions WHERE {where} ORDER BY "row"'
+    rows = [row for row, in con.execute(query, params)]
+    positions = data.index.get_indexer(rows)
+    return positions[positions >= 0]
+
+
+def get_session_query(values):
+    # `where` and `params` selecting the rows of a session, and those with an
+    # ID that already appeared in an earlier row of the session.
+    placeholders = ', '.join('?' * len(values))
+    where = f'session IN ({placeholders})'
+    duplicated_where = (f'{where} AND "row" NOT IN '
+                        f'(SELECT MIN("row") FROM questions '
+                        f'WHERE {where} GROUP BY id)')
+    return (where, tuple(values)), (duplicated_where, tuple(values) * 2)
+
+
+def get_session_key(session):
     if session == 1:
-        sessions = ('1', 'all')
+        key = 1
         # first_page_is_welcome = True
     elif session == 'last':
-        sessions = ('>1', 'all', 'last')
+        key = 'last'
     elif session > 1:
-        sessions = ('>1', 'all')
+        key = '>1'
         # first_page_is_welcome = False
 
-    data = data.loc[data['session'].isin(sessions), :]
+    return key
+
+
+def get_page_positions(pages):
+    # Row positions of each page, in order of first appearance.
+    page_ids, codes = pd.unique(pages), pd.factorize(pages)[0]
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes, minlength=len(page_ids)))[:-1]
+    return list(zip(page_ids, np.split(order, bounds)))
+
+
+def gen_data_index(data, con=None):
+    # Row positions of each session, of its pages and triggers (relative to
+    # the rows of the session), and of the `msg_*` rows. Build once after
+    # reading the data, and pass to the functions below. If `data` was read
+    # from the question store, pass the connection as `con` to look up the
+    # session and `msg_*` rows in its indexes instead of scanning `data`.
+    session_values = data['session'].to_numpy()
+    page_values = data['page'].to_numpy()
+    has_trigger = data['endSurveyIfResponse'].notnull().to_numpy()
+
+    sessions = dict()
+    for key, values in SESSION_SETS.items():
+        if con is None:
+            positions = np.flatnonzero(np.isin(session_values, values))
+        else:
+            session_query, _ = get_session_query(values)
+            positions = lookup_question_store(con, data, *session_query)
+
+        sessions[key] = dict(
+            positions=positions,
+            pages=get_page_positions(page_values[positions]),
+            triggers=np.flatnonzero(has_trigger[positions]))
+
+    if con is None:
+        # Check all sessions for duplicated IDs at once.
+        positions = [sessions[key]['positions'] for key in sessions]
+        membership = pd.DataFrame({
+            'session': np.repeat(np.arange(len(sessions)),
+                                 [len(p) for p in positions]),
+            'id': data['id'].to_numpy()[np.concatenate(positions)],
+            'position': np.concatenate(positions)})
+        duplicated = membership.loc[membership
+                                    .duplicated(subset=['session', 'id']), :]
+        for session_idx, key in enumerate(sessions):
+            sessions[key]['duplicated_ids'] = (
+                duplicated.loc[duplicated['session'] == session_idx,
+                               'position']
+                .to_numpy())
+
+        messages = np.flatnonzero(data['id']
+                                  .str.startswith('msg', na=False)
+                                  .to_numpy(dtype=bool))
+    else:
+        for key, values in SESSION_SETS.items():
+            _, duplicated_query = get_session_query(values)
+            sessions[key]['duplicated_ids'] = lookup_question_store(
+                con, data, *duplicated_query)
+
+        messages = lookup_question_store(con, data, where='id GLOB ?',
+                                         params=('msg*',))
+
+    index = dict(sessions=sessions, messages=messages)
+    return index
+
 
-    duplicated_ids = data['id'].duplicated()
-    if duplicated_ids.any():
+def filter_data_by_session(data, session, index=None):
+    key = get_session_key(session)
+
+    if isinstance(data, sqlite3.Connection):
+        # Only read the rows of the session, and check them for duplicated
+        # IDs in the question store.
+        con = data
+        session_query, duplicated_query = get_session_query(SESSION_SETS[key])
+        data = query_question_store(con, *session_query)
+        duplicated_ids = lookup_question_store(con, data, *duplicated_query)
+        positions = np.arange(len(data))
+    else:
+        if index is None:
+            index = gen_data_index(data)
+        duplicated_ids = index['sessions'][key]['duplicated_ids']
+        positions = index['sessions'][key]['positions']
+
+    if len(duplicated_ids):
         msg = (f'The following questions had duplicated IDs: '
-               f'{data[duplicated_ids]}')
+               f'{data.iloc[duplicated_ids]}')
         raise ValueError(msg)
 
+    data = data.take(positions)
     return data
 
 
-def extract_question_data(q_data):
-    q_type = q_data['type'].iloc[0]
-    q_required = bool(q_data['required'].iloc[0])
+def get_column_positions(data):
+    return {col: pos for pos, col in enumerate(data.columns)}
+
 
-    if q_data['onlyVisibleIf'].isnull().iloc[0]:
+def extract_question_data(q_record, col_pos):
+    q_type = q_record[col_pos['type']]
+    q_required = bool(q_record[col_pos['required']])
+
+    if pd.isnull(q_record[col_pos['onlyVisibleIf']]):
         q_visible_if = None
     else:
-        q_visible_if = f"{q_data['onlyVisibleIf'].iloc[0]}"
+        q_visible_if = f"{q_record[col_pos['onlyVisibleIf']]}"
 
-    q_title = {lang: q_data[f'title_{lang}'].iloc[0]
+    q_title = {lang: q_record[col_pos[f'title_{lang}']]
                for lang in LANGUAGES}
 
     # Extract semi-colon-separated choices, and strip leading and
@@ -89,7 +262,7 @@ def extract_question_data(q_data):
     else:
         choices = {}
         for lang in LANGUAGES:
-            choices[lang] = q_data[f'choices_{lang}'].iloc[0]
+            choices[lang] = q_record[col_pos[f'choices_{lang}']]
             choices[lang] = choices[lang].split(';')
             choices[lang] = [c.strip() for c in choices[lang]]
 
@@ -97,7 +270,7 @@ def extract_question_data(q_data):
         for lang in LANGUAGES[1:]:
             if num_choices_en != len(choices[lang]):
                 msg = (f'Mismatch in number of choices for en vs {lang}: '
-                       f'{q_data["id"].iloc[0]}')
+                       f'{q_record[col_pos["id"]]}')
                 print(msg)
                 # Inject English choices so we can proceed.
                 choices[lang] = choices['en']
@@ -397,7 +570,7 @@ def gen_info(q_id, q_title, q_visible_if=''):
     return info
 
 
-def gen_image(q_id, filename, q_visible_if=''):
+def gen_image(q_id, filename, q_visible_if='', assets=None):
     question = {
         "type": "image",
         "name": q_id,
@@ -405,12 +578,22 @@ def gen_image(q_id, filename, q_visible_if=''):
         "visibleIf": q_visible_if
     }
 
+    # Use the content-hashed URL from the asset manifest, if available, and
+    # keep the aspect ratio of the image at the default display width.
+    if assets is not None and filename in assets:
+        asset = assets[filename]
+        question["imageLink"] = asset['url']
+        if asset['width']:
+            question["imageWidth"] = IMAGE_DISPLAY_WIDTH
+            question["imageHeight"] = round(IMAGE_DISPLAY_WIDTH *
+                                            asset['height'] / asset['width'])
+
     return question
 
 
-def gen_question(*, q_id, q_data, previous_home_test_item, language,
-                 other_text, none_text):
-    extracted = extract_question_data(q_data)
+def gen_question(*, q_id, q_record, col_pos, previous_home_test_item,
+                 language, other_text, none_text, assets=None):
+    extracted = extract_question_data(q_record=q_record, col_pos=col_pos)
     q_type, q_title, q_choices, q_required, visible_if = extracted
 
     if q_type == 'radio':
@@ -490,8 +673,8 @@ def gen_question(*, q_id, q_data, previous_home_test_item, language,
         question = gen_header(q_id=q_id, q_title=q_title,
                               q_visible_if=visible_if)
     elif q_type == 'image':
-        question = gen_image(q_id=q_id, filename=q_title,
-                             q_visible_if=visible_if)
+        question = gen_image(q_id=q_id, filename=q_title['en'].strip(),
+                             q_visible_if=visible_if, assets=assets)
     elif q_type == 'study_id':
         question = gen_text(q_id=q_id, q_title=q_title,
                             placeholder=q_choices[0],
@@ -506,7 +689,11 @@ def gen_question(*, q_id, q_data, previous_home_test_item, language,
     return question
 
 
-def gen_pages(data, previous_home_test_item, language):
+def gen_pages(data, previous_home_test_item, language, assets=None,
+              page_positions=None):
+    if page_positions is None:
+        page_positions = get_page_positions(data['page'].to_numpy())
+
     pages = []
 
     NONE_TEXT = {lang: (data
@@ -519,29 +706,119 @@ def gen_pages(data, previous_home_test_item, language):
                          .iloc[0])
                   for lang in LANGUAGES}
 
-    for page_id, page_data in data.groupby('page', sort=False):
+    # Convert the rows to plain tuples only once. Only the first row of each
+    # ID on a page is used – just like grouping by page and ID would do.
+    col_pos = get_column_positions(data)
+    id_pos = col_pos['id']
+    q_records = list(data.itertuples(index=False, name=None))
+
+    for page_id, positions in page_positions:
         page = dict(name=str(page_id), elements=[])
         pages.append(page)
 
-        for question_id, question_data in page_data.groupby('id', sort=False):
+        question_ids = set()
+        for pos in positions:
+            q_record = q_records[pos]
+            question_id = q_record[id_pos]
+            if question_id in question_ids:
+                continue
+            question_ids.add(question_id)
+
             element = gen_question(
-                q_id=question_id, q_data=question_data,
+                q_id=question_id, q_record=q_record, col_pos=col_pos,
                 previous_home_test_item=previous_home_test_item,
-                language=language, other_text=OTHER_TEXT, none_text=NONE_TEXT)
+                language=language, other_text=OTHER_TEXT, none_text=NONE_TEXT,
+                assets=assets)
             page['elements'].append(element)
 
     return pages
 
 
-def gen_triggers(data):
-    questions_with_triggers = (data
-                               .loc[~data['endSurveyIfResponse']
-                                    .isnull(), :])
+def collect_image_filenames(data):
+    filenames = data.loc[data['type'] == 'image', 'title_en']
+    filenames = sorted(set(filenames.dropna().str.strip()))
+    return filenames
+
+
+def describe_asset(path):
+    stat = path.stat()
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+
+    # Only reads the image header, not the pixel data.
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+    except UnidentifiedImageError:  # e.g. SVG
+        width, height = None, None
+
+    asset = dict(hash=sha256.hexdigest(), size=stat.st_size,
+                 mtime_ns=stat.st_mtime_ns, width=width, height=height)
+    return asset
+
+
+def gen_asset_manifest(filenames, assets_dir, manifest_path, n_jobs=None):
+    if manifest_path.exists():
+        with open(manifest_path, encoding='utf8') as f:
+            previous_manifest = json_tricks.load(f)
+    else:
+        previous_manifest = dict()
+
+    # Re-use the hashes of files that have not changed since the last run.
+    manifest = dict()
+    changed = []
+    for filename in filenames:
+        path = assets_dir / filename
+        if not path.is_file():
+            print(f'Missing image: {path}')
+            continue
+
+        stat = path.stat()
+        cached = previous_manifest.get(filename)
+        if (cached is not None and
+                cached['mtime_ns'] == stat.st_mtime_ns and
+                cached['size'] == stat.st_size):
+            manifest[filename] = cached
+        else:
+            changed.append(filename)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        paths = [assets_dir / filename for filename in changed]
+        for filename, asset in zip(changed, pool.map(describe_asset, paths)):
+            asset['url'] = f'assets/{filename}?v={asset["hash"][:12]}'
+            manifest[filename] = asset
+
+    manifest = {filename: manifest[filename] for filename in sorted(manifest)}
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(manifest_path, 'w', encoding='utf8') as f:
+        json_tricks.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+def gen_triggers(data, trigger_positions=None):
+    if trigger_positions is None:
+        trigger_positions = np.flatnonzero(data['endSurveyIfResponse']
+                                           .notnull()
+                                           .to_numpy())
+
+    col_pos = get_column_positions(data)
+    id_pos = col_pos['id']
+    trigger_pos = col_pos['endSurveyIfResponse']
+    questions_with_triggers = data.iloc[trigger_positions]
 
     triggers = []
-    for question_id, question_data in (questions_with_triggers
-                                       .groupby('id', sort=False)):
-        trigger_if = question_data['endSurveyIfResponse'].iloc[0]
+    question_ids = set()
+    q_records = questions_with_triggers.itertuples(index=False, name=None)
+    for q_record in q_records:
+        question_id = q_record[id_pos]
+        if question_id in question_ids:
+            continue
+        question_ids.add(question_id)
+
+        trigger_if = q_record[trigger_pos]
 
         if trigger_if.startswith('>='):
             comparison = '>='
@@ -557,67 +834,79 @@ def gen_triggers(data):
     return triggers
 
 
-def randomize_taste_order(data):
-    data = data.copy()
-
+def randomize_taste_order(data, page_positions):
+    # Shuffle the rows of the tastes across the taste pages by re-assigning
+    # row positions of the index's pages, instead of moving the rows of
+    # `data` around. All other rows stay on their pages. Only the "how to
+    # taste" graphics are added to `data` (in place).
     tastes = ('sweet', 'sour', 'salty', 'bitter')
-    taste_vals = dict()
-    taste_idx = dict()
+    ids = data['id'].to_numpy()
+    pages = data['page'].to_numpy()
+
+    taste_rows = dict()
     taste_page = dict()
     for taste in tastes:
-        taste_vals[taste] = (data
-                             .loc[[taste in i for i in data['id']], :]
-                             .copy())
-        taste_idx[taste] = taste_vals[taste].index
-        taste_page[taste] = taste_vals[taste]['page'].values[0]
+        taste_rows[taste] = np.flatnonzero([taste in i for i in ids])
+        taste_page[taste] = pages[taste_rows[taste][0]]
 
+    # The n-th taste page receives the rows of the n-th randomly drawn taste,
+    # in place of the rows of the taste it held before.
     random_taste_order = np.random.choice(tastes, 4, replace=False)
-    first_taste_page = sorted(taste_page.values())[0]
-    randomized_taste_vals = list()
-
-    page = first_taste_page
-    for taste in random_taste_order:
-        vals = taste_vals[taste]
-        vals['page'] = [page] * 3
-        randomized_taste_vals.append(vals)
-        page += 1
-
-    first_taste_idx = np.array(list(taste_idx.values())).flatten().min()
-    randomized_taste_idx = list()
+    original_tastes = sorted(tastes, key=lambda taste: taste_page[taste])
+    replacement = dict(zip(original_tastes, random_taste_order))
+
+    row_taste = {pos: taste
+                 for taste in tastes for pos in taste_rows[taste]}
+    randomized_page_positions = []
+    for page_id, positions in page_positions:
+        randomized_positions = []
+        for pos in positions:
+            taste = row_taste.get(pos)
+            if taste is None:
+                randomized_positions.append(pos)
+            elif pos == taste_rows[taste][0]:
+                randomized_positions.extend(taste_rows[replacement[taste]])
+        randomized_page_positions.append(
+            (page_id, np.array(randomized_positions, dtype=positions.dtype)))
 
-    taste_idx = first_taste_idx
-    for _ in tastes:
-        for i in range(3):
-            randomized_taste_idx.append(taste_idx + i)
-        taste_idx += 3
+    # Add "how to taste" graphics.
+    pos = taste_rows[random_taste_order[0]][1]
+    for lang in LANGUAGES:
+        col = data.columns.get_loc(f'title_{lang}')
+        how_to_taste = data.loc[data['id'] == 'how_to_taste',
+                                f'title_{lang}'].iloc[0]
+        data.iloc[pos, col] += f'\n\n{how_to_taste}'
 
-    randomized_taste_df = pd.DataFrame()
-    for vals in randomized_taste_vals:
-        randomized_taste_df = randomized_taste_df.append(vals,
-                                                         ignore_index=True)
+    return randomized_page_positions
 
-    randomized_taste_df.index = randomized_taste_idx
 
-    # Add "how to taste" graphics.
-    for lang in LANGUAGES:
-        col = f'title_{lang}'
-        how_to_taste = data.loc[data['id'] == 'how_to_taste', col].iloc[0]
-        idx = randomized_taste_df.index[1]
-        randomized_taste_df.loc[idx, col] += f'\n\n{how_to_taste}'
+def load_data(infile):
+    # Read the Excel sheet or the question store, and index it. Load once and
+    # pass both to `gen_survey_json` and `gen_html_elements`.
+    if is_question_store(infile):
+        with contextlib.closing(sqlite3.connect(infile)) as con:
+            data = query_question_store(con)
+            index = gen_data_index(data, con=con)
+    else:
+        data = read_data(infile)
+        index = gen_data_index(data)
 
-    data.loc[randomized_taste_idx, :] = randomized_taste_df
-    return data
+    return data, index
 
 
-def gen_survey_json(infile, session, previous_home_test_item, language):
-    data = read_data(infile)
-    data = filter_data_by_session(data=data, session=session)
-    data = randomize_taste_order(data)
+def gen_survey_json(data, index, session, previous_home_test_item, language,
+                    assets=None):
+    session_index = index['sessions'][get_session_key(session)]
+    data = filter_data_by_session(data=data, session=session, index=index)
+    page_positions = randomize_taste_order(
+        data, page_positions=session_index['pages'])
 
     pages = gen_pages(data=data,
                       previous_home_test_item=previous_home_test_item,
-                      language=language)
-    triggers = gen_triggers(data=data)
+                      language=language, assets=assets,
+                      page_positions=page_positions)
+    triggers = gen_triggers(data=data,
+                            trigger_positions=session_index['triggers'])
 
     first_page_is_welcome = False
 
@@ -641,10 +930,8 @@ def gen_survey_json(infile, session, previous_home_test_item, language):
     return json
 
 
-def gen_html_elements(infile, language):
-    data = read_data(infile)
-    data = data.loc[[True if x.startswith('msg') else False
-                     for x in data['id']], :]
+def gen_html_elements(data, index, language):
+    data = data.take(index['messages'])
 
     title_row = f'title_{language}'
     html_item = dict()
@@ -667,8 +954,16 @@ def gen_html_elements(infile, language):
 
 
 if __name__ == '__main__':
+    data, index = load_data(infile)
+    assets = gen_asset_manifest(
+        filenames=collect_image_filenames(data),
+        assets_dir=assets_dir, manifest_path=asset_manifest_path)
+
     sessions = [1, 2]
 
     for language, session in zip(LANGUAGES, sessions):
-        gen_survey_json(infile=infile, session=session, language=language,
-                        previous_home_test_item=None)
+        gen_survey_json(data=data, index=index, session=session,
+                        language=language, previous_home_test_item=None,
+                        assets=assets)
+
+    write_question_store(data, outfile=question_store)
@@ -0,0 +1,194 @@
+"""
+Report translation coverage and text expansion for all languages (number of
+empty, untranslated and overly long titles and choices compared to the
+English version).
+
+COVERAGE REPORT
+
+"""
+
+import importlib
+import pandas as pd
+import numpy as np
+import pathlib
+import sys
+
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent))
+full_check = importlib.import_module('02_check_translations_full')
+infile = full_check.infile
+outdir = pathlib.Path(__file__).parent.parent / 'reports'
+
+# A translation is considered "much longer" than English (and hence a layout
+# risk) if it has more than this many times the number of characters.
+EXPANSION_THRESHOLD = 1.5
+
+# Question types whose choices are never shown to participants.
+TYPES_WITHOUT_CHOICES = ('header', 'info', 'comment', 'country_selector',
+                         'date', 'image', 'email')
+
+# Question types whose titles are not meant to be translated.
+TYPES_WITHOUT_TRANSLATABLE_TITLE = ('image',)
+
+METRICS = ('empty', 'untranslated', 'expanded')
+
+
+def get_languages(data):
+    # All languages in the sheet, not only those in `LANGUAGES`, so that new
+    # languages are reported before the check scripts know about them.
+    languages = tuple(col[len('title_'):] for col in data.columns
+                      if col.startswith('title_'))
+    unchecked = [lang for lang in languages
+                 if lang not in full_check.LANGUAGES]
+    if unchecked:
+        print(f'Languages not yet included in LANGUAGES of the check '
+              f'scripts: {", ".join(unchecked)}')
+
+    return languages
+
+
+def normalize_texts(data, field, languages):
+    # All `<field>_<lang>` columns at once, as stripped strings; missing
+    # values (including the "nan" produced by `read_data` casting
+    # `choices_en` to `str`) become empty strings.
+    cols = [f'{field}_{lang}' for lang in languages]
+    texts = data[cols].astype('string').fillna('')
+    texts = texts.apply(lambda col: col.str.strip())
+    texts = texts.mask(texts == 'nan', '')
+    texts.columns = list(languages)
+    return texts
+
+
+def calc_field_stats(data, field, languages):
+    texts = normalize_texts(data, field, languages)
+    lengths = texts.apply(lambda col: col.str.len()).astype('float64')
+
+    en_text = texts['en']
+    en_length = lengths['en'].replace(0, np.nan)
+
+    if field == 'choices':
+        relevant = ~data['type'].isin(TYPES_WITHOUT_CHOICES)
+    else:
+        relevant = ~data['type'].isin(TYPES_WITHOUT_TRANSLATABLE_TITLE)
+    relevant = relevant.to_numpy(dtype=bool) & (en_text != '').to_numpy()
+
+    # Texts without any letters (numbers, year ranges, …) are legitimately
+    # identical across languages.
+    has_letters = (en_text
+                   .str.contains(r'[^\W\d_]', regex=True)
+                   .to_numpy(dtype=bool, na_value=False))
+
+    empty = (lengths == 0).to_numpy()
+    identical = texts.eq(en_text, axis=0).to_numpy(dtype=bool,
+                                                   na_value=False)
+    untranslated = identical & has_letters[:, np.newaxis] & ~empty
+    ratio = lengths.div(en_length, axis=0).to_numpy()
+    expanded = np.nan_to_num(ratio, nan=0) > EXPANSION_THRESHOLD
+
+    # One row per question and language.
+    n_rows, n_langs = texts.shape
+    stats = pd.DataFrame({
+        'session': np.repeat(data['session'].to_numpy(), n_langs),
+        'type': np.repeat(data['type'].to_numpy(), n_langs),
+        'id': np.repeat(data['id'].to_numpy(), n_langs),
+        'field': field,
+        'language': np.tile(np.array(languages), n_rows),
+        'relevant': np.repeat(relevant, n_langs),
+        'empty': empty.ravel(),
+        'untranslated': untranslated.ravel(),
+        'expanded': expanded.ravel(),
+    })
+    stats = stats.loc[stats['relevant'] & (stats['language'] != 'en'), :]
+    stats = stats.drop(columns='relevant')
+
+    return stats
+
+
+def calc_translation_stats(data, languages):
+    stats = pd.concat([calc_field_stats(data, field='title',
+                                        languages=languages),
+                       calc_field_stats(data, field='choices',
+                                        languages=languages)],
+                      ignore_index=True)
+    stats['translated'] = ~(stats['empty'] | stats['untranslated'])
+    return stats
+
+
+def summarize_stats(stats):
+    metrics = list(METRICS)
+    by = {'overall': ['field', 'language'],
+          'session': ['session', 'field', 'language'],
+          'type': ['type', 'field', 'language']}
+
+    summary = []
+    for breakdown, group_cols in by.items():
+        counts = stats.groupby(group_cols)[metrics].sum()
+        counts['total'] = stats.groupby(group_cols).size()
+        counts = counts.reset_index()
+        if breakdown == 'overall':
+            counts.insert(0, 'group', 'all')
+        else:
+            counts = counts.rename(columns={breakdown: 'group'})
+        counts.insert(0, 'breakdown', breakdown)
+        summary.append(counts)
+
+    summary = pd.concat(summary, ignore_index=True)
+    return summary
+
+
+def calc_coverage_matrix(stats, languages):
+    # Fraction of translated titles and choices, with one column per
+    # language and one row per session and question type.
+    overall = (stats
+               .groupby('language')['translated']
+               .mean()
+               .to_frame()
+               .T)
+    overall.index = pd.MultiIndex.from_tuples([('overall', 'all')])
+
+    matrices = [overall]
+    for breakdown in ('session', 'type'):
+        matrix = (stats
+                  .groupby([breakdown, 'language'])['translated']
+                  .mean()
+                  .unstack('language'))
+        matrix.index = pd.MultiIndex.from_product([[breakdown],
+                                                   matrix.index])
+        matrices.append(matrix)
+
+    matrix = pd.concat(matrices)
+    matrix.index.names = ['breakdown', 'group']
+    matrix.columns.name = None
+    matrix = matrix[[lang for lang in languages
+                     if lang in matrix.columns]]
+    return matrix
+
+
+def write_table(df, outdir, name):
+    outdir.mkdir(parents=True, exist_ok=True)
+    df = df.reset_index() if df.index.names != [None] else df
+
+    df.to_csv(outdir / f'{name}.csv', index=False)
+    df.to_json(outdir / f'{name}.json', orient='records', indent=2,
+               force_ascii=False)
+    df.to_html(outdir / f'{name}.html', index=False,
+               float_format='{:.2f}'.format)
+
+
+def gen_coverage_report(infile, outdir):
+    data = full_check.read_data(infile, languages=None)
+    languages = get_languages(data)
+    stats = calc_translation_stats(data, languages=languages)
+    summary = summarize_stats(stats)
+    matrix = calc_coverage_matrix(stats, languages=languages)
+
+    write_table(summary, outdir=outdir, name='translation_stats')
+    write_table(matrix, outdir=outdir, name='translation_coverage')
+
+    return summary, matrix
+
+
+if __name__ == '__main__':
+    summary, matrix = gen_coverage_report(infile=infile, outdir=outdir)
+    print(matrix.loc['overall'].to_string())
+    print(f'\nReports written to: {outdir}')
@@ -0,0 +1,278 @@
+"""
+Validate collected survey responses against the questions in the Excel sheet
+(choice values, year and slider ranges, country names, and answers to
+questions that should have been hidden).
+
+RESPONSE VALIDATION
+
+"""
+
+import collections
+import concurrent.futures
+import importlib
+import json
+import pandas as pd
+import pathlib
+import re
+import sys
+import time
+
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent))
+full_check = importlib.import_module('02_check_translations_full')
+infile = full_check.infile
+
+# Every `*.jsonl` file in this folder is validated; each line must contain
+# the SurveyJS data of one response.
+responses_dir = pathlib.Path(__file__).parent.parent / 'responses'
+outdir = pathlib.Path(__file__).parent.parent / 'reports'
+
+CHOICE_TYPES = ('radio', 'radio_with_other_option', 'checkbox',
+                'checkbox_with_other_option', 'checkbox_with_none_option',
+                'checkbox_with_other_and_none_options', 'dropdown')
+SLIDER_RANGE = (0, 100)
+
+# Simple SurveyJS conditions, e.g. `{smell_loss} = 'Yes'`, optionally
+# combined with `and` / `or`. Other expressions are not checked.
+CONDITION_PATTERN = re.compile(
+    r"""^\{(?P<q_id>[^{}]+)\}\s*"""
+    r"""(?P<op>=|==|!=|<>|>=|<=|>|<|notcontains|contains)\s*"""
+    r"""(?:'(?P<sq>[^']*)'|"(?P<dq>[^"]*)"|(?P<bare>[\w.\-]+))$""")
+OR_PATTERN = re.compile(r'\s+or\s+', flags=re.IGNORECASE)
+AND_PATTERN = re.compile(r'\s+and\s+', flags=re.IGNORECASE)
+
+
+def get_country_names():
+    # Same list as offered by `gen_country_selector`.
+    names = {country['name'] for country in full_check.countries
+             if country['name'] != 'Republic of Kosovo'}
+    return names
+
+
+def parse_condition(expression):
+    # Returns a list of alternatives (`or`), each a list of clauses (`and`),
+    # or None if the expression is not supported.
+    alternatives = []
+    for alternative in OR_PATTERN.split(expression.strip()):
+        clauses = []
+        for clause in AND_PATTERN.split(alternative.strip()):
+            match = CONDITION_PATTERN.match(clause.strip())
+            if match is None:
+                return None
+
+            value = next(v for v in match.group('sq', 'dq', 'bare')
+                         if v is not None)
+            clauses.append((match['q_id'].strip(), match['op'], value))
+        alternatives.append(clauses)
+
+    return alternatives
+
+
+def build_rules(data):
+    country_names = get_country_names()
+    col_pos = full_check.get_column_positions(data)
+    rules = dict()
+    conditions = collections.defaultdict(list)
+
+    # The same ID may appear for several sessions; accept the values of all
+    # of them.
+    for q_record in data.itertuples(index=False, name=None):
+        q_id = q_record[col_pos['id']]
+        extracted = full_check.extract_question_data(
+            q_record=q_record, col_pos=col_pos)
+        q_type, _, q_choices, _, q_visible_if = extracted
+
+        rule = rules.setdefault(q_id, dict(type=q_type, values=None,
+                                           bounds=None, visible_if=None))
+        conditions[q_id].append(q_visible_if)
+
+        if q_type in CHOICE_TYPES:
+            values = {choice['value'] for choice in q_choices}
+            if 'other' in q_type:
+                values.add('other')
+            if 'none' in q_type:
+                values.add('none')
+            rule['values'] = (rule['values'] or set()) | values
+        elif q_type == 'country_selector':
+            rule['values'] = country_names
+        elif q_type == 'year_selector':
+            rule['bounds'] = (int(q_choices[0]['value']),
+                              int(q_choices[1]['value']))
+        elif q_type == 'slider':
+            rule['bounds'] = SLIDER_RANGE
+
+    # Responses do not record their session, so a question counts as
+    # visible if it is visible in any of its sessions: the conditions of all
+    # sessions are combined with `or`. Questions that are shown without a
+    # condition in any session, or have an unsupported one, are not checked.
+    for q_id, q_conditions in conditions.items():
+        if None in q_conditions:
+            continue
+
+        alternatives = [parse_condition(condition)
+                        for condition in dict.fromkeys(q_conditions)]
+        if None in alternatives:
+            continue
+
+        rules[q_id]['visible_if'] = [clauses for alternative in alternatives
+                                     for clauses in alternative]
+
+    return rules
+
+
+def is_answered(value):
+    return value not in (None, '', [])
+
+
+def compare(answer, op, value):
+    if op in ('contains', 'notcontains'):
+        if isinstance(answer, list):
+            found = value in [str(a) for a in answer]
+        else:
+            found = answer is not None and value in str(answer)
+        return found if op == 'contains' else not found
+
+    if isinstance(answer, list):
+        answers = [str(a) for a in answer]
+    elif answer is None:
+        answers = []
+    else:
+        answers = [str(answer)]
+
+    if op in ('=', '=='):
+        return value in answers
+    elif op in ('!=', '<>'):
+        return value not in answers
+
+    try:
+        answer = float(answers[0])
+        value = float(value)
+    except (IndexError, ValueError):
+        return False
+
+    if op == '>=':
+        return answer >= value
+    elif op == '<=':
+        return answer <= value
+    elif op == '>':
+        return answer > value
+    else:
+        return answer < value
+
+
+def is_visible(condition, response):
+    return any(all(compare(response.get(q_id), op, value)
+                   for q_id, op, value in clauses)
+               for clauses in condition)
+
+
+def validate_response(response, rules):
+    violations = []
+    for q_id, answer in response.items():
+        rule = rules.get(q_id)
+        if rule is None or not is_answered(answer):
+            continue
+
+        if (rule['visible_if'] is not None and
+                not is_visible(rule['visible_if'], response)):
+            violations.append((q_id, 'hidden_answer', answer))
+
+        if rule['values'] is not None:
+            answers = answer if isinstance(answer, list) else [answer]
+            kind = ('invalid_country' if rule['type'] == 'country_selector'
+                    else 'invalid_choice')
+            for a in answers:
+                if not isinstance(a, str) or a not in rule['values']:
+                    violations.append((q_id, kind, a))
+        elif rule['bounds'] is not None:
+            try:
+                number = float(answer)
+            except (TypeError, ValueError):
+                violations.append((q_id, 'not_a_number', answer))
+                continue
+
+            low, high = rule['bounds']
+            if not low <= number <= high:
+                violations.append((q_id, 'out_of_range', answer))
+
+    return violations
+
+
+def validate_file(path, rules, outdir):
+    # Reads one response at a time and writes each violation immediately, so
+    # memory use does not depend on the size of the file.
+    path = pathlib.Path(path)
+    outfile = outdir / f'{path.stem}.violations.jsonl'
+    counts = collections.Counter()
+    n_responses = 0
+
+    start = time.perf_counter()
+    with open(path, encoding='utf8') as f, \
+            open(outfile, 'w', encoding='utf8') as out:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+
+            try:
+                response = json.loads(line)
+            except json.JSONDecodeError:
+                response = None
+
+            if isinstance(response, dict):
+                n_responses += 1
+                violations = validate_response(response, rules)
+            else:
+                violations = [(None, 'invalid_json', line.strip()[:100])]
+
+            for q_id, kind, value in violations:
+                counts[(q_id, kind)] += 1
+                out.write(json.dumps(dict(line=line_no, id=q_id, kind=kind,
+                                          value=value),
+                                     ensure_ascii=False) + '\n')
+
+    summary = dict(file=path.name, responses=n_responses,
+                   bytes=path.stat().st_size,
+                   seconds=time.perf_counter() - start, counts=counts)
+    return summary
+
+
+def validate_responses(files, rules, outdir, n_jobs=None):
+    outdir.mkdir(parents=True, exist_ok=True)
+    counts = collections.Counter()
+    n_responses = n_bytes = 0
+
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [pool.submit(validate_file, path=path, rules=rules,
+                               outdir=outdir)
+                   for path in files]
+        for future in concurrent.futures.as_completed(futures):
+            summary = future.result()
+            n_responses += summary['responses']
+            n_bytes += summary['bytes']
+            counts.update(summary['counts'])
+
+            n_violations = sum(summary['counts'].values())
+            rate = summary['responses'] / max(summary['seconds'], 1e-9)
+            print(f'{summary["file"]}: {summary["responses"]} responses, '
+                  f'{n_violations} violations ({rate:,.0f} responses/s)')
+    seconds = time.perf_counter() - start
+
+    violations = pd.DataFrame([(q_id, kind, count)
+                               for (q_id, kind), count in counts.items()],
+                              columns=['id', 'kind', 'count'])
+    violations = violations.sort_values(by='count', ascending=False)
+    violations.to_csv(outdir / 'response_violations.csv', index=False)
+
+    print(f'\nTotal: {n_responses} responses in {len(files)} files, '
+          f'{violations["count"].sum()} violations, {seconds:.1f} s '
+          f'({n_responses / max(seconds, 1e-9):,.0f} responses/s, '
+          f'{n_bytes / 1e6 / max(seconds, 1e-9):,.1f} MB/s)')
+
+    return violations
+
+
+if __name__ == '__main__':
+    rules = build_rules(full_check.read_data(infile))
+    files = sorted(responses_dir.glob('*.jsonl'))
+    validate_responses(files=files, rules=rules, outdir=outdir)
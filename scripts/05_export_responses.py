@@ -0,0 +1,263 @@
+"""
+Export collected survey responses to a columnar file (Parquet or Feather),
+using the questions in the Excel sheet as codebook.
+
+RESPONSE EXPORT
+
+"""
+
+import collections
+import importlib
+import json
+import pandas as pd
+import pathlib
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet
+import sys
+
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent))
+full_check = importlib.import_module('02_check_translations_full')
+infile = full_check.infile
+
+# Every `*.jsonl` file in this folder is exported to a file of the same name
+# in `outdir`; each line must contain the SurveyJS data of one response.
+responses_dir = pathlib.Path(__file__).parent.parent / 'responses'
+outdir = pathlib.Path(__file__).parent.parent / 'exports'
+OUTPUT_FORMAT = 'parquet'  # or 'feather'
+
+# Number of responses held in memory (and written as one row group / record
+# batch) at a time.
+CHUNK_SIZE = 50_000
+
+SINGLE_CHOICE_TYPES = ('radio', 'radio_with_other_option', 'dropdown',
+                       'country_selector')
+MULTIPLE_CHOICE_TYPES = ('checkbox', 'checkbox_with_other_option',
+                         'checkbox_with_none_option',
+                         'checkbox_with_other_and_none_options')
+NUMERIC_TYPES = ('slider', 'number')
+TEXT_TYPES = ('comment', 'text', 'email', 'study_id', 'date')
+
+
+def get_country_names():
+    # Same order as offered by `gen_country_selector` in English.
+    names = sorted(country['name'] for country in full_check.countries
+                   if country['name'] != 'Republic of Kosovo')
+    return names
+
+
+def build_codebook(data):
+    country_names = get_country_names()
+    col_pos = full_check.get_column_positions(data)
+    codebook = dict()
+
+    # The same ID may appear for several sessions; the first one wins.
+    for q_record in data.itertuples(index=False, name=None):
+        q_id = q_record[col_pos['id']]
+        if q_id in codebook:
+            continue
+
+        extracted = full_check.extract_question_data(
+            q_record=q_record, col_pos=col_pos)
+        q_type, _, q_choices, _, _ = extracted
+
+        if q_type in SINGLE_CHOICE_TYPES + MULTIPLE_CHOICE_TYPES:
+            if q_type == 'country_selector':
+                values = list(country_names)
+            else:
+                values = [choice['value'] for choice in q_choices]
+            if 'other' in q_type:
+                values.append('other')
+            if 'none' in q_type:
+                values.append('none')
+            # Drop duplicates, keeping the order of the choices.
+            values = list(dict.fromkeys(values))
+            codebook[q_id] = dict(type=q_type, values=values)
+        elif q_type in NUMERIC_TYPES + TEXT_TYPES + ('year_selector',):
+            codebook[q_id] = dict(type=q_type, values=None)
+
+    return codebook
+
+
+def get_columns(codebook):
+    # Column name -> pandas data type.
+    columns = dict()
+    for q_id, entry in codebook.items():
+        q_type = entry['type']
+        if q_type in SINGLE_CHOICE_TYPES:
+            columns[q_id] = pd.CategoricalDtype(categories=entry['values'])
+        elif q_type in MULTIPLE_CHOICE_TYPES:
+            for value in entry['values']:
+                columns[f'{q_id}[{value}]'] = 'boolean'
+        elif q_type == 'year_selector':
+            columns[q_id] = 'Int32'
+        elif q_type in NUMERIC_TYPES:
+            columns[q_id] = 'Float64'
+        else:
+            columns[q_id] = 'string'
+
+        # Free text entered for the "other" option.
+        if 'other' in q_type:
+            columns[f'{q_id}-Comment'] = 'string'
+
+    return columns
+
+
+def to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_integer(value):
+    number = to_number(value)
+    if number is None or not number.is_integer() or abs(number) >= 2**31:
+        return None
+    return int(number)
+
+
+def gen_chunk(responses, codebook, columns, invalid_answers):
+    # Answers that cannot be stored (values not in the codebook, or not a
+    # number) become missing, and are counted per question in
+    # `invalid_answers`.
+    chunk = dict()
+    for q_id, entry in codebook.items():
+        q_type = entry['type']
+        answers = [response.get(q_id) for response in responses]
+
+        if q_type in SINGLE_CHOICE_TYPES:
+            values = set(entry['values'])
+            valid = [a if isinstance(a, str) and a in values else None
+                     for a in answers]
+            invalid_answers[q_id] += sum(a is not None and v is None
+                                         for a, v in zip(answers, valid))
+            chunk[q_id] = pd.Categorical(valid, dtype=columns[q_id])
+        elif q_type in MULTIPLE_CHOICE_TYPES:
+            values = set(entry['values'])
+            selected = []
+            for a in answers:
+                if isinstance(a, list):
+                    is_valid = [isinstance(v, str) and v in values for v in a]
+                    invalid_answers[q_id] += is_valid.count(False)
+                    selected.append({v for v, ok in zip(a, is_valid) if ok})
+                else:
+                    invalid_answers[q_id] += a is not None
+                    selected.append(None)
+            for value in entry['values']:
+                chunk[f'{q_id}[{value}]'] = pd.array(
+                    [None if s is None else value in s for s in selected],
+                    dtype='boolean')
+        elif q_type == 'year_selector':
+            years = [to_integer(a) for a in answers]
+            invalid_answers[q_id] += sum(a is not None and y is None
+                                         for a, y in zip(answers, years))
+            chunk[q_id] = pd.array(years, dtype='Int32')
+        elif q_type in NUMERIC_TYPES:
+            numbers = [to_number(a) for a in answers]
+            invalid_answers[q_id] += sum(a is not None and n is None
+                                         for a, n in zip(answers, numbers))
+            chunk[q_id] = pd.array(numbers, dtype='Float64')
+        else:
+            chunk[q_id] = pd.array([None if a is None else str(a)
+                                    for a in answers], dtype='string')
+
+        if 'other' in q_type:
+            comments = [response.get(f'{q_id}-Comment')
+                        for response in responses]
+            chunk[f'{q_id}-Comment'] = pd.array(comments, dtype='string')
+
+    chunk = pd.DataFrame(chunk).astype(columns)
+    return chunk
+
+
+def read_chunks(path, chunk_size, invalid_lines):
+    # Lines that do not contain a JSON object are skipped, and their line
+    # numbers appended to `invalid_lines`.
+    with open(path, encoding='utf8') as f:
+        responses = []
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+
+            try:
+                response = json.loads(line)
+            except json.JSONDecodeError:
+                response = None
+
+            if not isinstance(response, dict):
+                invalid_lines.append(line_no)
+                continue
+
+            responses.append(response)
+            if len(responses) == chunk_size:
+                yield responses
+                responses = []
+
+        if responses:
+            yield responses
+
+
+def export_responses(path, codebook, outfile, output_format=OUTPUT_FORMAT,
+                     chunk_size=CHUNK_SIZE):
+    columns = get_columns(codebook)
+    empty = pd.DataFrame({col: pd.Series(dtype=dtype)
+                          for col, dtype in columns.items()})
+    schema = pa.Schema.from_pandas(empty, preserve_index=False)
+    # Keep the pandas metadata, so the data types are restored on reading.
+    schema = schema.with_metadata({
+        **schema.metadata,
+        b'codebook': json.dumps(codebook, ensure_ascii=False)})
+
+    if output_format == 'parquet':
+        writer = pa.parquet.ParquetWriter(outfile, schema=schema)
+    elif output_format == 'feather':
+        writer = pa.ipc.new_file(outfile, schema=schema)
+    else:
+        raise ValueError(f'Unknown output format: {output_format}')
+
+    n_responses = 0
+    invalid_lines = []
+    invalid_answers = collections.Counter()
+    with writer:
+        for responses in read_chunks(path, chunk_size=chunk_size,
+                                     invalid_lines=invalid_lines):
+            chunk = gen_chunk(responses, codebook=codebook, columns=columns,
+                              invalid_answers=invalid_answers)
+            table = pa.Table.from_pandas(chunk, schema=schema,
+                                         preserve_index=False)
+            writer.write_table(table)
+            n_responses += len(responses)
+
+    invalid_answers = +invalid_answers  # Drop zero counts.
+    summary = dict(responses=n_responses, invalid_lines=invalid_lines,
+                   invalid_answers=invalid_answers)
+    return summary
+
+
+if __name__ == '__main__':
+    codebook = build_codebook(full_check.read_data(infile))
+    outdir.mkdir(parents=True, exist_ok=True)
+    with open(outdir / 'codebook.json', 'w', encoding='utf8') as f:
+        json.dump(codebook, f, ensure_ascii=False, indent=2)
+
+    for path in sorted(responses_dir.glob('*.jsonl')):
+        outfile = outdir / f'{path.stem}.{OUTPUT_FORMAT}'
+        summary = export_responses(path=path, codebook=codebook,
+                                   outfile=outfile)
+        print(f'{path.name}: {summary["responses"]} responses written to '
+              f'{outfile}')
+
+        if summary['invalid_lines']:
+            print(f'\tSkipped {len(summary["invalid_lines"])} invalid lines: '
+                  f'{summary["invalid_lines"][:10]}')
+
+        if summary['invalid_answers']:
+            invalid_answers = pd.DataFrame(
+                summary['invalid_answers'].most_common(),
+                columns=['id', 'count'])
+            invalid_answers.to_csv(outdir / f'{path.stem}.invalid_answers.csv',
+                                   index=False)
+            print(f'\t{invalid_answers["count"].sum()} invalid answers '
+                  f'(stored as missing) in {len(invalid_answers)} questions')
@@ -0,0 +1,142 @@
+"""
+Benchmark the per-question cost of `gen_pages` in the full check, comparing
+the current implementation against the previous nested `groupby('page')` /
+`groupby('id')` with one `Series.iloc[0]` lookup per column.
+
+BENCHMARK
+
+"""
+
+import importlib
+import json_tricks
+import pathlib
+import sys
+import timeit
+from unittest import mock
+
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent))
+full_check = importlib.import_module('02_check_translations_full')
+LANGUAGES = full_check.LANGUAGES
+infile = full_check.infile
+REPEAT = 5
+
+
+def extract_question_data_groupby(q_record, col_pos=None):
+    # Previous implementation of `extract_question_data`, operating on a
+    # single-row DataFrame (passed as `q_record` by `gen_question`).
+    q_data = q_record
+    q_type = q_data['type'].iloc[0]
+    q_required = bool(q_data['required'].iloc[0])
+
+    if q_data['onlyVisibleIf'].isnull().iloc[0]:
+        q_visible_if = None
+    else:
+        q_visible_if = f"{q_data['onlyVisibleIf'].iloc[0]}"
+
+    q_title = {lang: q_data[f'title_{lang}'].iloc[0]
+               for lang in LANGUAGES}
+
+    # Extract semi-colon-separated choices, and strip leading and
+    # trailing whitespaces.
+    if q_type in ['header', 'info', 'comment',
+                  'country_selector', 'date', 'image', 'email']:
+        q_choices = []
+    else:
+        choices = {}
+        for lang in LANGUAGES:
+            choices[lang] = q_data[f'choices_{lang}'].iloc[0]
+            choices[lang] = choices[lang].split(';')
+            choices[lang] = [c.strip() for c in choices[lang]]
+
+        num_choices_en = len(choices['en'])
+        for lang in LANGUAGES[1:]:
+            if num_choices_en != len(choices[lang]):
+                msg = (f'Mismatch in number of choices for en vs {lang}: '
+                       f'{q_data["id"].iloc[0]}')
+                print(msg)
+                # Inject English choices so we can proceed.
+                choices[lang] = choices['en']
+
+        q_choices = []
+        for idx, value in enumerate(choices['en']):
+            text = {lang: choices[lang][idx]
+                    for lang in LANGUAGES}
+            q_choices.append({'value': value,
+                              'text': text})
+
+    return q_type, q_title, q_choices, q_required, q_visible_if
+
+
+def gen_pages_groupby(data, previous_home_test_item, language):
+    # Previous implementation of `gen_pages`. The questions themselves are
+    # generated by the current `gen_question`, which is handed the
+    # single-row DataFrame and extracts it with the previous implementation.
+    pages = []
+
+    NONE_TEXT = {lang: (data
+                        .loc[data['id'] == 'msg_none', f'title_{lang}']
+                        .iloc[0])
+                 for lang in LANGUAGES}
+
+    OTHER_TEXT = {lang: (data
+                         .loc[data['id'] == 'msg_other', f'title_{lang}']
+                         .iloc[0])
+                  for lang in LANGUAGES}
+
+    with mock.patch.object(full_check, 'extract_question_data',
+                           extract_question_data_groupby):
+        for page_id, page_data in data.groupby('page', sort=False):
+            page = dict(name=str(page_id), elements=[])
+            pages.append(page)
+
+            questions = page_data.groupby('id', sort=False)
+            for question_id, question_data in questions:
+                element = full_check.gen_question(
+                    q_id=question_id, q_record=question_data, col_pos=None,
+                    previous_home_test_item=previous_home_test_item,
+                    language=language, other_text=OTHER_TEXT,
+                    none_text=NONE_TEXT)
+                page['elements'].append(element)
+
+    return pages
+
+
+def time_per_question(func, n_questions, **kwargs):
+    timer = timeit.Timer(lambda: func(**kwargs))
+    n_loops, _ = timer.autorange()
+    best = min(timer.repeat(repeat=REPEAT, number=n_loops)) / n_loops
+    return best / n_questions * 1e6
+
+
+def run_benchmark(data, language='en'):
+    kwargs = dict(data=data, previous_home_test_item=None, language=language)
+
+    expected = json_tricks.dumps(gen_pages_groupby(**kwargs), sort_keys=False)
+    actual = json_tricks.dumps(full_check.gen_pages(**kwargs),
+                               sort_keys=False)
+    if actual != expected:
+        raise RuntimeError('gen_pages output differs from the previous '
+                           'groupby-based implementation.')
+
+    n_questions = len(data)
+    results = {
+        'gen_pages (groupby)': time_per_question(gen_pages_groupby,
+                                                 n_questions, **kwargs),
+        'gen_pages': time_per_question(full_check.gen_pages, n_questions,
+                                       **kwargs),
+    }
+
+    print(f'{n_questions} questions, best of {REPEAT} runs:')
+    for name, usec in results.items():
+        print(f'  {name:<20} {usec:8.1f} µs / question')
+    speedup = results['gen_pages (groupby)'] / results['gen_pages']
+    print(f'  speedup              {speedup:8.1f}x')
+
+    return results
+
+
+if __name__ == '__main__':
+    data = full_check.read_data(infile)
+    data = full_check.filter_data_by_session(data=data, session=1)
+    run_benchmark(data)